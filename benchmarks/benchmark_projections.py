@@ -0,0 +1,97 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import grid_distillation_lib_demo as gd
+
+
+PROJECTIONS = ['pca', 'randomized', 'incremental']
+
+
+def make_images(n_images, image_size, rank=20, seed=0):
+    # low-rank structure plus pixel noise, stored as uint8 like real image tensors
+    rng = np.random.default_rng(seed)
+    n_features = image_size * image_size * 3
+    scales = np.linspace(3.0, 0.5, rank)
+    latent = rng.normal(size=(n_images, rank)) * scales
+    basis = rng.normal(size=(rank, n_features)) / np.sqrt(rank)
+    X = latent @ basis + rng.normal(scale=0.3, size=(n_images, n_features))
+    X = (X - X.min()) / (X.max() - X.min()) * 255
+    labels = rng.integers(0, 5, size=n_images)
+    return X.astype(np.uint8).reshape(n_images, image_size, image_size, 3), labels
+
+
+def exact_components(X_flat, n_components=2):
+    X_centered = X_flat - X_flat.mean(axis=0)
+    _, _, vt = np.linalg.svd(X_centered, full_matrices=False)
+    return vt[:n_components]
+
+
+def captured_variance(X_flat, components):
+    X_centered = X_flat - X_flat.mean(axis=0)
+    return float(np.sum((X_centered @ components.T) ** 2))
+
+
+def run(n_images, image_size, chunk_size, repeats):
+    X, y = make_images(n_images, image_size)
+    X_flat = X.reshape(n_images, -1).astype(np.float64)
+    reference = exact_components(X_flat)
+    reference_variance = captured_variance(X_flat, reference)
+
+    results = []
+    for projection in PROJECTIONS:
+        timings = []
+        for _ in range(repeats):
+            sampler = gd.GridImageClusterSampler(X, y, n_clusters=5, n_samples=50,
+                                                 projection=projection, chunk_size=chunk_size)
+            # the incremental backend streams self.X and never reads the flat input
+            X_input = None if projection == 'incremental' else sampler.get_flat_input()
+            start = time.perf_counter()
+            sampler.fit_projection(X_input)
+            timings.append(time.perf_counter() - start)
+
+        components = sampler.pca.components_
+        # cosines of the principal angles between the fitted and the exact 2-D subspace
+        alignment = np.linalg.svd(components @ reference.T, compute_uv=False)
+        results.append({
+            'projection': projection,
+            'n_images': n_images,
+            'n_features': X_flat.shape[1],
+            'fit_seconds': min(timings),
+            'variance_ratio': captured_variance(X_flat, components) / reference_variance,
+            'subspace_alignment': float(alignment.min()),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time and accuracy of the 2-D projection backends.')
+    parser.add_argument('--n-images', type=int, nargs='+', default=[1000, 5000])
+    parser.add_argument('--image-size', type=int, default=64)
+    parser.add_argument('--chunk-size', type=int, default=4096)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default=None, help='optional JSON file for the results')
+    args = parser.parse_args()
+
+    results = []
+    for n_images in args.n_images:
+        results.extend(run(n_images, args.image_size, args.chunk_size, args.repeats))
+
+    print(f"{'projection':<12} {'images':>8} {'features':>9} {'fit [s]':>9} {'var ratio':>10} {'alignment':>10}")
+    for row in results:
+        print(f"{row['projection']:<12} {row['n_images']:>8} {row['n_features']:>9} {row['fit_seconds']:>9.3f} "
+              f"{row['variance_ratio']:>10.5f} {row['subspace_alignment']:>10.5f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
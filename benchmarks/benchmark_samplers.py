@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+import numpy as np
+import sklearn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import grid_distillation_lib_demo as gd
+
+
+def make_dataset(n_points, image_size=4, n_labels=5, n_blobs=20, seed=0):
+    # blobs of small uint8 "images", labels mixed across blobs like real classes
+    rng = np.random.default_rng(seed)
+    n_features = image_size * image_size
+    centers = rng.uniform(40, 215, size=(n_blobs, n_features))
+    blob_ids = rng.integers(0, n_blobs, size=n_points)
+    X = centers[blob_ids] + rng.normal(scale=12, size=(n_points, n_features))
+    X = np.clip(X, 0, 255).astype(np.uint8).reshape(n_points, image_size, image_size)
+    y = (blob_ids + rng.integers(0, 2, size=n_points)) % n_labels
+    return X, y
+
+
+def measure(function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def best_of(function, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(args):
+    results = []
+    for n_points in args.sizes:
+        X, y = make_dataset(n_points, seed=args.seed)
+        for shape in args.shapes:
+            sampler_class = gd.SHAPES[shape]
+            sampler = sampler_class(X, y, n_clusters=args.n_clusters, n_samples=args.n_samples[0],
+                                    clustering=args.clustering, dtype=args.dtype)
+            _, fit_seconds, fit_peak = measure(sampler.cluster_images)
+            results.append({
+                'stage': 'cluster_images',
+                'shape': shape,
+                'n_points': n_points,
+                'seconds': fit_seconds,
+                'peak_bytes': fit_peak,
+            })
+            print(f'{shape:<13} {n_points:>9} cluster_images {fit_seconds:9.3f}s {fit_peak / 2 ** 20:9.1f} MiB')
+
+            measured = set()
+            for n_samples in args.n_samples:
+                for grid_size in args.grid_sizes:
+                    variant = sampler_class.from_fitted(sampler, n_samples, grid_size or None)
+                    # an explicit grid size can match the shape default, measure it once
+                    if (n_samples, variant.get_cell_grid_size()) in measured:
+                        continue
+                    measured.add((n_samples, variant.get_cell_grid_size()))
+                    _, index_seconds, index_peak = measure(variant.build_cell_index)
+                    _, _, select_peak = measure(variant.get_selected_samples)
+                    select_seconds = best_of(variant.get_selected_samples, args.repeats)
+                    results.append({
+                        'stage': 'get_selected_samples',
+                        'shape': shape,
+                        'n_points': n_points,
+                        'n_samples': n_samples,
+                        'grid_size': variant.get_cell_grid_size(),
+                        'index_seconds': index_seconds,
+                        'index_peak_bytes': index_peak,
+                        'seconds': select_seconds,
+                        'peak_bytes': select_peak,
+                    })
+                    print(f'{shape:<13} {n_points:>9} n_samples={n_samples:<5} grid_size={variant.get_cell_grid_size():<5} '
+                          f'index {index_seconds:8.4f}s select {select_seconds:8.4f}s {select_peak / 2 ** 20:9.1f} MiB')
+    return results
+
+
+def result_key(row):
+    return (row['stage'], row['shape'], row['n_points'], row.get('n_samples'), row.get('grid_size'))
+
+
+def compare(results, baseline_path, tolerance):
+    # rows slower than tolerance times the baseline count as regressions
+    with open(baseline_path) as f:
+        baseline = {result_key(row): row for row in json.load(f)['results']}
+
+    regressions = []
+    for row in results:
+        reference = baseline.get(result_key(row))
+        if reference is not None and row['seconds'] > tolerance * reference['seconds']:
+            regressions.append((row, reference))
+
+    for row, reference in regressions:
+        print(f"REGRESSION {result_key(row)}: {row['seconds']:.4f}s vs baseline {reference['seconds']:.4f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time and memory of the grid samplers on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--shapes', nargs='+', default=list(gd.SHAPES), choices=list(gd.SHAPES))
+    parser.add_argument('--n-samples', type=int, nargs='+', default=[60, 100])
+    parser.add_argument('--grid-sizes', type=int, nargs='+', default=[0, 10, 40],
+                        help='0 keeps the shape default grid size')
+    parser.add_argument('--n-clusters', type=int, default=10)
+    parser.add_argument('--clustering', default='kmeans', choices=['kmeans', 'minibatch'])
+    parser.add_argument('--dtype', default='float64', choices=['float64', 'float32'])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_samplers.json')
+    parser.add_argument('--baseline', default=None, help='earlier output to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.output, 'w') as f:
+        json.dump({
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'sklearn': sklearn.__version__,
+            'machine': platform.machine(),
+            'args': vars(args),
+            'results': results,
+        }, f, indent=2)
+
+    if args.baseline and compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
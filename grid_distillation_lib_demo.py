@@ -1,11 +1,27 @@
 
+import os
+import json
+import time
+import hashlib
+import pickle
+import threading
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection, PolyCollection
 
-from sklearn.cluster import KMeans
-from sklearn.decomposition import PCA
+from sklearn.base import clone
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.manifold import TSNE
 from sklearn.model_selection import train_test_split
+from sklearn.utils import gen_batches
 
 """
 sampler = GridImageClusterSampler(X, y, n_clusters=2)
@@ -15,117 +31,992 @@ selected_samples_1350 = sampler.get_selected_samples(1350)
 sampler.plot_selected_samples_on_clusters(selected_samples_1350)
 """
 
+EXECUTORS = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}
+
+
+FILLS = ('uniform', 'density')
+
+# fitted state written by ImageClusterSampler.save, one .npy file each
+INDEX_ARRAYS = ('group_order', 'group_offsets', 'group_labels', 'group_clusters',
+                'index_order', 'cell_offsets', 'group_cell_offsets', 'cell_ids')
+
+
+def get_fill_weights(n_points, cell_starts, cell_counts, fill):
+    if fill == 'uniform':
+        return None
+
+    # density: a point weighs as much as the size of its cell, points outside every cell weigh 1
+    weights = np.ones(n_points)
+    offsets = np.repeat(cell_starts - np.cumsum(cell_counts) + cell_counts, cell_counts)
+    weights[offsets + np.arange(cell_counts.sum())] = np.repeat(cell_counts, cell_counts)
+    return weights
+
+
+def fill_samples(sampled_indices, cluster_indices, n_samples, rng=np.random, weights=None):
+    # top up in one draw, without replacement, from the points not selected yet
+    n_missing = n_samples - len(sampled_indices)
+    if n_missing <= 0:
+        return sampled_indices[:n_samples]
+
+    available = ~np.isin(cluster_indices, sampled_indices)
+    candidates = np.asarray(cluster_indices)[available]
+    p = None if weights is None else weights[available] / weights[available].sum()
+    fill = rng.choice(candidates, size=min(n_missing, len(candidates)), replace=False, p=p)
+
+    return sampled_indices + fill.tolist()
+
+
+def sample_index_group(cluster_indices, cell_starts, cell_counts, n_samples, rng=np.random, stats=None,
+                       fill='uniform'):
+    stats = NULL_STATS if stats is None else stats
+    if len(cluster_indices) <= n_samples:
+        return np.sort(cluster_indices)
+
+    with stats.timer('cell_draws'):
+        picks = cell_starts + (rng.random(len(cell_starts)) * cell_counts).astype(int)
+        sampled_indices = cluster_indices[picks].tolist()
+
+    with stats.timer('top_up'):
+        weights = get_fill_weights(len(cluster_indices), cell_starts, cell_counts, fill)
+        return fill_samples(sampled_indices, cluster_indices, n_samples, rng, weights)
+
+
+def sample_index_group_batch(cluster_indices, cell_starts, cell_counts, n_samples, n_runs, rng=np.random,
+                             fill='uniform'):
+    # n_runs independent draws of sample_index_group as an (n_runs, k) array
+    if len(cluster_indices) <= n_samples:
+        return np.tile(np.sort(cluster_indices), (n_runs, 1))
+
+    picks = cell_starts + (rng.random((n_runs, len(cell_starts))) * cell_counts).astype(int)
+    sampled_indices = cluster_indices[picks]
+
+    n_missing = n_samples - len(cell_starts)
+    if n_missing > 0:
+        # the n_missing smallest random keys per run are a draw without replacement;
+        # exponential keys scaled by the weights make it a weighted one
+        keys = rng.random((n_runs, len(cluster_indices)))
+        weights = get_fill_weights(len(cluster_indices), cell_starts, cell_counts, fill)
+        if weights is not None:
+            keys = -np.log1p(-keys) / weights
+        keys[np.arange(n_runs)[:, None], picks] = np.inf
+        fill_positions = np.argpartition(keys, n_missing - 1, axis=1)[:, :n_missing]
+        sampled_indices = np.concatenate([sampled_indices, cluster_indices[fill_positions]], axis=1)
+
+    return sampled_indices[:, :n_samples]
+
+
+def sample_label_shard(template, shm_name, shape, dtype, start, stop, y, random_state):
+    # one label's rows are a contiguous slice of the shared array, the sampler
+    # fits on a view of it and only the selected indices go back
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        sampler = type(template).__new__(type(template))
+        sampler.__dict__.update(template.__dict__)
+        sampler.X = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[start:stop]
+        sampler.y = y
+        sampler.stats = NULL_STATS
+        # a label can hold fewer rows than there are clusters
+        sampler.n_clusters = min(template.n_clusters, stop - start)
+        sampler.kmeans = clone(template.kmeans).set_params(n_clusters=sampler.n_clusters)
+        sampler.cluster_images()
+        selected_indices = np.asarray(sampler.get_selected_samples(random_state=random_state), dtype=np.int64)
+        del sampler
+    finally:
+        shm.close()
+    return selected_indices
+
+
+class SamplerStats:
+    enabled = True
+
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.groups = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.timings[stage] += elapsed
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def record_group(self, label, cluster, **counters):
+        with self.lock:
+            self.groups.append(dict(label=label, cluster=cluster, **counters))
+            for name, value in counters.items():
+                self.counters[name] += value
+
+    def reset(self):
+        with self.lock:
+            self.timings.clear()
+            self.counters.clear()
+            self.groups.clear()
+
+    def summary(self):
+        lines = [f'{stage:<16} {seconds:10.4f} s' for stage, seconds in self.timings.items()]
+        lines += [f'{name:<16} {value:10d}' for name, value in self.counters.items()]
+        return '\n'.join(lines)
+
+
+class NullStats:
+    # stand-in when instrumentation is off, every hook is a no-op
+    enabled = False
+
+    def timer(self, stage):
+        return nullcontext()
+
+    def count(self, name, value=1):
+        pass
+
+    def record_group(self, label, cluster, **counters):
+        pass
+
+
+NULL_STATS = NullStats()
+
+
+class ClusteringCache:
+    def __init__(self, directory, max_bytes=2 ** 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def make_key(self, X, estimators, settings=(), block_rows=1024):
+        # content hash of X, read in row blocks so memmapped arrays stay on disk
+        digest = hashlib.sha256()
+        digest.update(repr((X.shape, str(X.dtype))).encode())
+        for start in range(0, X.shape[0], block_rows):
+            digest.update(np.ascontiguousarray(X[start:start + block_rows]).tobytes())
+        for estimator in estimators:
+            params = sorted(estimator.get_params().items())
+            digest.update(repr((type(estimator).__name__, params)).encode())
+        digest.update(repr(settings).encode())
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    def load(self, key):
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(path)
+        return state
+
+    def store(self, key, state):
+        path = self.get_path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        # drop least recently used entries until the cache fits in max_bytes
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                os.remove(os.path.join(self.directory, name))
+
+
 class ImageClusterSampler:
-    def __init__(self, X, y, n_clusters, n_samples):
+    def __init__(self, X, y, n_clusters, n_samples, grid_size=None, cache=None, clustering=None, chunk_size=4096,
+                 projection=None, n_components=None, stats=None, fill='uniform', dtype=np.float64):
+        if isinstance(X, (str, os.PathLike)):
+            X = np.load(X, mmap_mode='r')
         self.X = X
+        self.streamed = isinstance(X, np.memmap)
+        if clustering is None:
+            clustering = 'minibatch' if self.streamed else 'kmeans'
+        if projection is None:
+            projection = 'incremental' if self.streamed else 'pca'
         self.y = y
         self.n_clusters = n_clusters
         self.n_samples = n_samples
+        self.grid_size = grid_size
+        self.cache = ClusteringCache(cache) if isinstance(cache, (str, os.PathLike)) else cache
+        self.clustering = clustering
+        self.projection = projection
+        self.n_components = n_components
+        self.chunk_size = chunk_size
+        self.stats = NULL_STATS if stats is None else stats
+        if fill not in FILLS:
+            raise ValueError(f"Unknown fill '{fill}', expected one of {FILLS}")
+        self.fill = fill
+        # compute dtype of clustering, projection and binning; sklearn keeps float32 as float32
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError(f"Unknown dtype '{self.dtype}', expected float32 or float64")
         self.cluster_labels = None
         self.X_pca = None
-        self.kmeans = KMeans(n_clusters=self.n_clusters, random_state=42)
-        self.pca = PCA(n_components=2, random_state=42)
+        self.X_reduced = None
+        self.bounds = None
+        self.reduced_bounds = None
+        self.group_order = None
+        self.group_labels = None
+        self.group_clusters = None
+        self.index_order = None
+        self.group_offsets = None
+        self.group_cell_offsets = None
+        self.cell_offsets = None
+        self.cell_ids = None
+        if clustering == 'kmeans':
+            self.kmeans = KMeans(n_clusters=self.n_clusters, random_state=42)
+        elif clustering == 'minibatch':
+            self.kmeans = MiniBatchKMeans(n_clusters=self.n_clusters, batch_size=chunk_size, random_state=42)
+        else:
+            raise ValueError(f"Unknown clustering mode '{clustering}', expected 'kmeans' or 'minibatch'")
+        # with n_components set, KMeans runs on the reduced space and the first
+        # two components double as the grid coordinates
+        pca_components = n_components or 2
+        if projection == 'pca':
+            self.pca = PCA(n_components=pca_components, random_state=42)
+        elif projection == 'randomized':
+            self.pca = PCA(n_components=pca_components, svd_solver='randomized', iterated_power=4, random_state=42)
+        elif projection == 'incremental':
+            # each partial_fit is an SVD over (batch + components) rows, small batches are much cheaper
+            self.pca = IncrementalPCA(n_components=pca_components, batch_size=min(chunk_size, max(128, 2 * pca_components)))
+        else:
+            raise ValueError(f"Unknown projection '{projection}', expected 'pca', 'randomized' or 'incremental'")
     
     def cluster_images(self):
-        self.kmeans.fit(self.X.reshape(self.X.shape[0], -1))
-        self.cluster_labels = self.kmeans.labels_
-        self.X_pca = self.pca.fit_transform(self.X.reshape(self.X.shape[0], -1))
+        state = None
+        if self.cache is not None:
+            with self.stats.timer('cache'):
+                cache_key = self.cache.make_key(self.X, [self.kmeans, self.pca], settings=(self.n_components, self.dtype.str))
+                state = self.cache.load(cache_key)
+        
+        if state is None:
+            self.fit_models()
+            if self.cache is not None:
+                self.cache.store(cache_key, {
+                    'kmeans': self.kmeans,
+                    'pca': self.pca,
+                    'cluster_labels': self.cluster_labels,
+                    'X_reduced': self.X_reduced,
+                })
+        else:
+            self.kmeans = state['kmeans']
+            self.pca = state['pca']
+            self.cluster_labels = state['cluster_labels']
+            self.X_reduced = state['X_reduced']
+            self.X_pca = self.X_reduced[:, :2]
+        
+        self.bounds = None
+        self.reduced_bounds = None
+        self.group_order = None
+        self.build_cell_index()
+
+    def fit_models(self):
+        with self.stats.timer('reshape'):
+            X_flat = self.get_flat_input()
+        if self.n_components is None:
+            with self.stats.timer('kmeans'):
+                self.fit_clustering(X_flat)
+            with self.stats.timer('pca'):
+                self.fit_projection(X_flat)
+        else:
+            with self.stats.timer('pca'):
+                self.fit_projection(X_flat)
+            with self.stats.timer('kmeans'):
+                self.fit_clustering(self.X_reduced)
+
+    def get_flat_input(self):
+        X_flat = self.X.reshape(self.X.shape[0], -1)
+        clusters_in_memory = self.clustering == 'kmeans' and self.n_components is None
+        fits_in_memory = clusters_in_memory or self.projection != 'incremental'
+        if fits_in_memory and not self.streamed and X_flat.dtype != self.dtype:
+            # convert once here instead of once per estimator, chunk by chunk
+            # so no float64 temporary of the whole array is ever made
+            X_converted = np.empty(X_flat.shape, dtype=self.dtype)
+            for start, chunk in self.iter_chunks():
+                X_converted[start:start + len(chunk)] = chunk
+            X_flat = X_converted
+        return X_flat
+
+    def fit_clustering(self, X_flat):
+        if self.clustering == 'minibatch':
+            self.fit_kmeans_streaming(self.X if self.n_components is None else X_flat)
+        else:
+            self.kmeans.fit(X_flat)
+            self.cluster_labels = self.kmeans.labels_
+
+    def fit_projection(self, X_flat):
+        if self.projection == 'incremental':
+            self.fit_pca_streaming()
+        else:
+            self.X_reduced = self.pca.fit_transform(X_flat)
+        self.X_pca = self.X_reduced[:, :2]
 
-    def plot_clusters(self):
-        plt.figure(figsize=(10, 6))
+    def iter_chunks(self, X=None, rows=None):
+        # flattened row blocks of X, or of X[rows] with start counting through
+        # rows; only one block is materialized at a time
+        X = self.X if X is None else X
+        n_rows = X.shape[0] if rows is None else len(rows)
+        for start in range(0, n_rows, self.chunk_size):
+            if rows is None:
+                chunk = X[start:start + self.chunk_size]
+            else:
+                chunk = X[rows[start:start + self.chunk_size]]
+            yield start, chunk.reshape(chunk.shape[0], -1).astype(self.dtype, copy=False)
+
+    def fit_kmeans_streaming(self, X=None):
+        # first pass updates the centers chunk by chunk, second pass assigns labels;
+        # partial_fit continues from any earlier fit, so start from a clean clone
+        self.kmeans = clone(self.kmeans)
+        for _, chunk in self.iter_chunks(X):
+            self.kmeans.partial_fit(chunk)
+        
+        self.cluster_labels = np.empty(self.X.shape[0], dtype=np.int32)
+        for start, chunk in self.iter_chunks(X):
+            self.cluster_labels[start:start + len(chunk)] = self.kmeans.predict(chunk)
+
+    def partial_fit_pca(self, rows=None):
+        for _, chunk in self.iter_chunks(rows=rows):
+            for batch in gen_batches(len(chunk), self.pca.batch_size, min_batch_size=self.pca.n_components):
+                self.pca.partial_fit(chunk[batch])
+
+    def fit_pca_streaming(self):
+        # partial_fit continues from any earlier fit, so start from a clean clone
+        self.pca = clone(self.pca)
+        self.partial_fit_pca()
+        
+        self.X_reduced = np.empty((self.X.shape[0], self.pca.n_components), dtype=self.dtype)
+        for start, chunk in self.iter_chunks():
+            self.X_reduced[start:start + len(chunk)] = self.pca.transform(chunk)
+
+    def get_bounds(self):
+        if self.bounds is None:
+            x_min, y_min = np.min(self.X_pca[:, :2], axis=0)
+            x_max, y_max = np.max(self.X_pca[:, :2], axis=0)
+            self.bounds = (x_min, x_max, y_min, y_max)
+        return self.bounds
+
+    def get_reduced_bounds(self):
+        if self.reduced_bounds is None:
+            self.reduced_bounds = (np.min(self.X_reduced, axis=0), np.max(self.X_reduced, axis=0))
+        return self.reduced_bounds
+
+    def get_cell_grid_size(self):
+        return 1
+
+    def get_cell_count(self):
+        return 1
+
+    def get_cell_ids(self, indices):
+        # the plain sampler has no grid, every group is a single cell
+        return np.zeros(len(indices), dtype=int)
+
+    def get_group_cell_ids(self):
+        # cell of every point in group_order; shapes whose cells depend on
+        # the group override this
+        return self.get_cell_ids(self.group_order)
+
+    def build_group_index(self):
+        # points sorted by (label, cluster); shape independent, so samplers
+        # made with from_fitted share it
+        labels, label_codes = np.unique(self.y, return_inverse=True)
+        order = np.lexsort((self.cluster_labels, label_codes))
+        group_keys = label_codes[order] * self.n_clusters + self.cluster_labels[order]
+        group_change = np.r_[True, group_keys[1:] != group_keys[:-1]]
+        
+        self.group_order = order.astype(np.int32)
+        self.group_offsets = np.r_[np.flatnonzero(group_change), len(order)].astype(np.int32)
+        self.group_labels = labels[label_codes[order][group_change]]
+        self.group_clusters = self.cluster_labels[order][group_change]
+
+    def build_cell_index(self):
+        # CSR-style index: points sorted by (label, cluster, cell), with
+        # offsets of every (label, cluster) group and of every cell run
+        if self.group_order is None:
+            self.build_group_index()
+        
+        with self.stats.timer('binning'):
+            cell_ids = self.get_group_cell_ids()
+        
+        with self.stats.timer('index'):
+            group_ids = np.repeat(np.arange(len(self.group_offsets) - 1), np.diff(self.group_offsets))
+            within = np.lexsort((cell_ids, group_ids))
+            group_ids, cell_ids = group_ids[within], cell_ids[within]
+            
+            cell_change = np.r_[True, (group_ids[1:] != group_ids[:-1]) | (cell_ids[1:] != cell_ids[:-1])]
+            cell_starts = np.flatnonzero(cell_change)
+            
+            self.index_order = self.group_order[within]
+            self.cell_offsets = np.r_[cell_starts, len(within)].astype(np.int32)
+            self.group_cell_offsets = np.searchsorted(cell_starts, self.group_offsets).astype(np.int32)
+            self.cell_ids = cell_ids[cell_starts]
+
+    @classmethod
+    def from_fitted(cls, sampler, n_samples=None, grid_size=None):
+        # a sampler of another shape or budget on top of already fitted state;
+        # n_samples and grid_size left as None are inherited from sampler
+        new_sampler = cls.__new__(cls)
+        new_sampler.__dict__.update(sampler.__dict__)
+        new_sampler.n_samples = sampler.n_samples if n_samples is None else n_samples
+        new_sampler.grid_size = sampler.grid_size if grid_size is None else grid_size
+        new_sampler.index_order = None
+        new_sampler.cell_offsets = None
+        new_sampler.group_cell_offsets = None
+        new_sampler.cell_ids = None
+        if sampler.cluster_labels is not None:
+            if sampler.group_order is None:
+                sampler.build_group_index()
+            new_sampler.group_order = sampler.group_order
+            new_sampler.group_offsets = sampler.group_offsets
+            new_sampler.bounds = sampler.get_bounds()
+        return new_sampler
+
+    def sweep(self, shapes=None, budgets=None, random_state=None):
+        # selections for every (shape, n_samples) pair from one clustering fit;
+        # budgets that give the same cells reuse one cell index
+        shapes = list(SHAPES) if shapes is None else shapes
+        budgets = [self.n_samples] if budgets is None else budgets
+        if self.cluster_labels is None:
+            self.cluster_images()
+        
+        samplers = {}
+        selections = {}
+        for shape in shapes:
+            if shape not in SHAPES:
+                raise ValueError(f"Unknown shape '{shape}', expected one of {list(SHAPES)}")
+            for n_samples in budgets:
+                sampler = SHAPES[shape].from_fitted(self, n_samples, self.grid_size)
+                cell_key = (shape, sampler.get_cell_grid_size())
+                if cell_key in samplers:
+                    sampler = samplers[cell_key].with_budget(n_samples)
+                else:
+                    sampler.build_cell_index()
+                    samplers[cell_key] = sampler
+                selections[shape, n_samples] = sampler.get_selected_samples(random_state=random_state)
+        return selections
+
+    def with_budget(self, n_samples):
+        # same cells, different n_samples; the cell index arrays are shared
+        new_sampler = type(self).__new__(type(self))
+        new_sampler.__dict__.update(self.__dict__)
+        new_sampler.n_samples = n_samples
+        return new_sampler
+
+    def get_settings(self):
+        # constructor arguments that describe the sampler, without the data
+        return {
+            'n_clusters': self.n_clusters,
+            'n_samples': self.n_samples,
+            'grid_size': self.grid_size,
+            'clustering': self.clustering,
+            'projection': self.projection,
+            'n_components': self.n_components,
+            'chunk_size': self.chunk_size,
+            'fill': self.fill,
+            'dtype': self.dtype.name,
+        }
+
+    def save(self, directory, selections=None):
+        # a directory of .npy files plus sampler.json: estimator parameters,
+        # X_reduced as float32, cluster labels in the smallest unsigned type,
+        # the cell index and any selections given as {name: indices}; X is
+        # not saved. sampler.json is written last and marks the save complete
+        if self.cluster_labels is None:
+            self.cluster_images()
+        if self.index_order is None:
+            self.build_cell_index()
+        os.makedirs(directory, exist_ok=True)
+        
+        n_points = len(self.cluster_labels)
+        index_dtype = np.int32 if n_points < 2 ** 31 else np.int64
+        arrays = {
+            'kmeans_centers': self.kmeans.cluster_centers_,
+            'pca_components': self.pca.components_,
+            'pca_mean': self.pca.mean_,
+            'X_reduced': self.X_reduced.astype(np.float32),
+            'cluster_labels': self.cluster_labels.astype(np.min_scalar_type(self.n_clusters - 1)),
+            'y': np.asarray(self.y),
+        }
+        for name in INDEX_ARRAYS:
+            arrays[name] = getattr(self, name)
+        selections = {} if selections is None else selections
+        for name, selected_samples in selections.items():
+            arrays[f'selection_{name}'] = np.asarray(selected_samples, dtype=index_dtype)
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, f'{name}.npy'), array, allow_pickle=False)
+        
+        with open(os.path.join(directory, 'sampler.json'), 'w') as f:
+            json.dump({
+                'sampler': type(self).__name__,
+                'settings': self.get_settings(),
+                'selections': list(selections),
+            }, f, indent=2)
+
+    @classmethod
+    def load(cls, directory, X=None, mmap_mode='r'):
+        # the sampler class saved in the directory, ready to sample and plot
+        # without refitting; arrays are memory mapped unless mmap_mode is None.
+        # X is only needed for refitting or the sharded mode
+        with open(os.path.join(directory, 'sampler.json')) as f:
+            metadata = json.load(f)
+        
+        def load_array(name):
+            return np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode)
+        
+        sampler_classes = {sampler_class.__name__: sampler_class for sampler_class in [ImageClusterSampler, *SHAPES.values()]}
+        sampler = sampler_classes[metadata['sampler']](X, load_array('y'), **metadata['settings'])
+        
+        # estimators are rebuilt from their arrays: KMeans fitted on its own
+        # centers sets the fitted state predict needs, then keeps them exactly
+        # and gets its constructor parameters back; refits start from clones.
+        # The small estimator arrays are copied, memmaps are read-only
+        centers = np.array(load_array('kmeans_centers'))
+        params = sampler.kmeans.get_params()
+        sampler.kmeans.set_params(init=centers, n_init=1, max_iter=1).fit(centers)
+        sampler.kmeans.set_params(**params)
+        sampler.kmeans.cluster_centers_ = centers
+        sampler.pca.components_ = np.array(load_array('pca_components'))
+        sampler.pca.mean_ = np.array(load_array('pca_mean'))
+        sampler.pca.n_components_, sampler.pca.n_features_in_ = sampler.pca.components_.shape
+        
+        sampler.X_reduced = load_array('X_reduced')
+        sampler.X_pca = sampler.X_reduced[:, :2]
+        sampler.cluster_labels = load_array('cluster_labels')
+        for name in INDEX_ARRAYS:
+            setattr(sampler, name, load_array(name))
+        sampler.selections = {name: load_array(f'selection_{name}') for name in metadata['selections']}
+        return sampler
+
+    @contextmanager
+    def plot_figure(self, title, path=None):
+        # with a path the figure is rendered by Agg straight to the file, no
+        # pyplot state or display involved; without one it is shown as before
+        if path is None:
+            figure = plt.figure(figsize=(10, 6))
+        else:
+            figure = Figure(figsize=(10, 6))
+            FigureCanvasAgg(figure)
+        ax = figure.add_subplot()
+        yield ax
+        
+        ax.set_title(title)
+        ax.set_xlabel('PCA Component 1')
+        ax.set_ylabel('PCA Component 2')
+        ax.legend()
+        if path is None:
+            plt.show()
+        else:
+            figure.savefig(path)
+
+    def scatter_clusters(self, ax, alpha=None):
+        # one scatter per cluster, the points split with a single sort
+        order = np.argsort(self.cluster_labels, kind='stable')
+        offsets = np.r_[0, np.cumsum(np.bincount(self.cluster_labels, minlength=self.n_clusters))]
         for i in range(self.n_clusters):
-            cluster_data = self.X_pca[self.cluster_labels == i]
-            plt.scatter(cluster_data[:, 0], cluster_data[:, 1], label=f'Cluster {i}')
-        plt.title('Clustering of the Dataset')
-        plt.xlabel('PCA Component 1')
-        plt.ylabel('PCA Component 2')
-        plt.legend()
-        plt.show()
+            cluster_data = self.X_pca[order[offsets[i]:offsets[i + 1]]]
+            ax.scatter(cluster_data[:, 0], cluster_data[:, 1], label=f'Cluster {i}', alpha=alpha)
+
+    def add_cell_outlines(self, ax, vertices):
+        # every cell of a tessellation in one collection, vertices shaped (cells, corners, 2)
+        ax.add_collection(PolyCollection(vertices, facecolors='none', edgecolors='k', linestyles='--', alpha=0.5))
+        ax.autoscale_view()
+
+    def plot_clusters(self, path=None):
+        with self.plot_figure('Clustering of the Dataset', path) as ax:
+            self.scatter_clusters(ax)
     
-    def plot_selected_samples_on_clusters(self, selected_samples):
-        plt.figure(figsize=(10, 6))
-        for i in range(self.n_clusters):
-            cluster_data = self.X_pca[self.cluster_labels == i]
-            plt.scatter(cluster_data[:, 0], cluster_data[:, 1], label=f'Cluster {i}', alpha=0.5)
+    def plot_selected_samples_on_clusters(self, selected_samples, path=None, title='Clustering Selected Samples'):
+        with self.plot_figure(title, path) as ax:
+            self.scatter_clusters(ax, alpha=0.5)
+            selected_data = self.X_pca[selected_samples]
+            ax.scatter(selected_data[:, 0], selected_data[:, 1], color='red', label='Selected Samples', edgecolor='k')
+
+    def sample_cells(self, cluster_indices, cell_ids, n_samples, rng=np.random):
+        # one random point per occupied cell, cells visited in ascending id order
+        order = np.argsort(cell_ids, kind='stable')
+        cell_ids = cell_ids[order]
+        _, cell_starts, cell_counts = np.unique(cell_ids, return_index=True, return_counts=True)
+        inside = cell_ids[cell_starts] >= 0
+
+        return sample_index_group(np.asarray(cluster_indices)[order], cell_starts[inside], cell_counts[inside],
+                                  n_samples, rng, self.stats, self.fill)
+
+    def get_group_cells(self, group):
+        # the group's points in cell order plus the start and size of every
+        # occupied cell, relative to the group
+        start, stop = self.group_offsets[group], self.group_offsets[group + 1]
+        cluster_indices = self.index_order[start:stop]
+
+        first_cell, last_cell = self.group_cell_offsets[group], self.group_cell_offsets[group + 1]
+        cell_starts = self.cell_offsets[first_cell:last_cell]
+        cell_counts = self.cell_offsets[first_cell + 1:last_cell + 1] - cell_starts
+        inside = self.cell_ids[first_cell:last_cell] >= 0
+
+        return cluster_indices, cell_starts[inside] - start, cell_counts[inside]
+
+    def sample_group(self, group, rng=np.random):
+        return sample_index_group(*self.get_group_cells(group), self.n_samples, rng, self.stats, self.fill)
+
+    def record_group_stats(self):
+        n_cells = self.get_cell_count()
+        for group in range(len(self.group_offsets) - 1):
+            cluster_indices, cell_starts, _ = self.get_group_cells(group)
+            sampled = len(cluster_indices) > self.n_samples
+            occupied = len(cell_starts) if sampled else 0
+            self.stats.record_group(
+                self.group_labels[group].item(),
+                self.group_clusters[group].item(),
+                points_scanned=len(cluster_indices),
+                cells_visited=occupied,
+                empty_cells=n_cells - occupied if sampled else 0,
+                top_up_draws=max(self.n_samples - occupied, 0) if sampled else 0,
+            )
+
+    def get_selected_samples(self, random_state=None, executor=None, n_jobs=None):
+        if self.index_order is None:
+            self.build_cell_index()
+
+        n_groups = len(self.group_offsets) - 1
+        if random_state is None and executor is None:
+            rngs = [np.random] * n_groups
+        else:
+            # independent stream per group, so the result does not depend on scheduling
+            seeds = np.random.SeedSequence(random_state).spawn(n_groups)
+            rngs = [np.random.default_rng(seed) for seed in seeds]
+
+        with self.stats.timer('sampling'):
+            if executor is None:
+                groups = [self.sample_group(group, rng) for group, rng in zip(range(n_groups), rngs)]
+            else:
+                if executor not in EXECUTORS:
+                    raise ValueError(f"Unknown executor '{executor}', expected one of {sorted(EXECUTORS)}")
+                tasks = [self.get_group_cells(group) for group in range(n_groups)]
+                cluster_indices, cell_starts, cell_counts = zip(*tasks) if tasks else ((), (), ())
+                # stats objects hold a lock and stay in this process
+                group_stats = [self.stats if executor == 'thread' else None] * n_groups
+                with EXECUTORS[executor](max_workers=n_jobs) as pool:
+                    groups = list(pool.map(sample_index_group, cluster_indices, cell_starts, cell_counts,
+                                           [self.n_samples] * n_groups, rngs, group_stats, [self.fill] * n_groups))
+
+            selected_samples = []
+            for selected_indices in groups:
+                selected_samples.extend(selected_indices)
+
+        if self.stats.enabled:
+            self.record_group_stats()
+        return selected_samples
+
+    def get_sharded_selected_samples(self, n_jobs=None, random_state=None):
+        # one process per class label, each with its own clustering and
+        # projection fit; X is copied once into shared memory, sorted by
+        # label so every shard is a slice the workers view without copying
+        y = np.asarray(self.y)
+        order = np.argsort(y, kind='stable')
+        labels, shard_starts = np.unique(y[order], return_index=True)
+        shard_stops = np.r_[shard_starts[1:], len(y)]
+        n_components = self.n_components or 2
+        if np.any(shard_stops - shard_starts < n_components):
+            small = labels[shard_stops - shard_starts < n_components]
+            raise ValueError(f'Labels {small.tolist()} have fewer than n_components={n_components} rows to shard')
+        seeds = [int(seed.generate_state(1)[0]) for seed in np.random.SeedSequence(random_state).spawn(len(labels))]
         
-        selected_data = self.X_pca[selected_samples]
-        plt.scatter(selected_data[:, 0], selected_data[:, 1], color='red', label='Selected Samples', edgecolor='k')
+        shape, dtype = self.X.shape, self.X.dtype
+        shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+        try:
+            X_shared = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            for batch in gen_batches(len(order), self.chunk_size):
+                X_shared[batch] = self.X[order[batch]]
+            del X_shared
+            
+            # fitted state and the stats lock stay here, workers start from the settings
+            template = type(self).from_fitted(self, self.n_samples, self.grid_size)
+            template.kmeans, template.pca = clone(self.kmeans), clone(self.pca)
+            template.X, template.y, template.stats = None, None, None
+            template.cluster_labels = template.X_pca = template.X_reduced = None
+            template.bounds = template.reduced_bounds = None
+            template.group_order = template.group_offsets = None
+            
+            with self.stats.timer('sharded'):
+                with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                    shards = list(pool.map(sample_label_shard, [template] * len(labels), [shm.name] * len(labels),
+                                           [shape] * len(labels), [dtype] * len(labels), shard_starts, shard_stops,
+                                           [y[order[start:stop]] for start, stop in zip(shard_starts, shard_stops)],
+                                           seeds))
+        finally:
+            shm.close()
+            shm.unlink()
         
-        plt.title('Clustering Selected Samples')
-        plt.xlabel('PCA Component 1')
-        plt.ylabel('PCA Component 2')
-        plt.legend()
-        plt.show()
+        selected_samples = []
+        for start, selected_indices in zip(shard_starts, shards):
+            selected_samples.extend(order[start + selected_indices].tolist())
+        return selected_samples
+
+    def get_selected_samples_batch(self, n_runs, random_state=None):
+        # one cell index, n_runs independent selections, one row per run
+        if self.index_order is None:
+            self.build_cell_index()
+
+        rng = np.random if random_state is None else np.random.default_rng(random_state)
+        groups = [
+            sample_index_group_batch(*self.get_group_cells(group), self.n_samples, n_runs, rng, self.fill)
+            for group in range(len(self.group_offsets) - 1)
+        ]
+        return np.concatenate(groups, axis=1) if groups else np.empty((n_runs, 0), dtype=np.int32)
 
 
 class GridImageClusterSampler(ImageClusterSampler):
-    def plot_clusters_with_grids(self):
-        plt.figure(figsize=(10, 6))
-        for i in range(self.n_clusters):
-            cluster_data = self.X_pca[self.cluster_labels == i]
-            plt.scatter(cluster_data[:, 0], cluster_data[:, 1], label=f'Cluster {i}', alpha=0.5)
-        
-        grid_size = int(np.ceil(np.sqrt(self.n_samples)))
+    def plot_clusters_with_grids(self, path=None):
+        grid_size = self.get_cell_grid_size()
         x_min, x_max = np.min(self.X_pca[:, 0]), np.max(self.X_pca[:, 0])
         y_min, y_max = np.min(self.X_pca[:, 1]), np.max(self.X_pca[:, 1])
         
         x_grid = np.linspace(x_min, x_max, grid_size + 1)
         y_grid = np.linspace(y_min, y_max, grid_size + 1)
         
-        for x in x_grid:
-            plt.axvline(x=x, color='k', linestyle='--', alpha=0.5)
-        for y in y_grid:
-            plt.axhline(y=y, color='k', linestyle='--', alpha=0.5)
+        # grid lines as (line, endpoint, xy) segments
+        ones = np.ones(grid_size + 1)
+        vertical = np.stack([np.c_[x_grid, y_min * ones], np.c_[x_grid, y_max * ones]], axis=1)
+        horizontal = np.stack([np.c_[x_min * ones, y_grid], np.c_[x_max * ones, y_grid]], axis=1)
         
-        plt.title('Clustering with Grids')
-        plt.xlabel('PCA Component 1')
-        plt.ylabel('PCA Component 2')
-        plt.legend()
-        plt.show()
+        with self.plot_figure('Clustering with Grids', path) as ax:
+            self.scatter_clusters(ax, alpha=0.5)
+            ax.add_collection(LineCollection(np.concatenate([vertical, horizontal]), colors='k',
+                                             linestyles='--', alpha=0.5))
     
     def get_grid_sampled_indices(self, cluster_indices, n_samples):
         if len(cluster_indices) <= n_samples:
             return cluster_indices
         
         grid_size = int(np.ceil(np.sqrt(n_samples)))
-        x_min, x_max = np.min(self.X_pca[:, 0]), np.max(self.X_pca[:, 0])
-        y_min, y_max = np.min(self.X_pca[:, 1]), np.max(self.X_pca[:, 1])
+        cell_ids = self.get_grid_cell_ids(cluster_indices, grid_size)
+        return self.sample_cells(cluster_indices, cell_ids, n_samples)
+
+    def get_cell_grid_size(self):
+        return self.grid_size or int(np.ceil(np.sqrt(self.n_samples)))
+
+    def get_cell_count(self):
+        return self.get_cell_grid_size() ** 2
+
+    def get_cell_ids(self, indices):
+        return self.get_grid_cell_ids(indices, self.get_cell_grid_size())
+
+    def get_grid_cell_ids(self, cluster_indices, grid_size):
+        x_min, x_max, y_min, y_max = self.get_bounds()
         
-        x_grid = np.linspace(x_min, x_max, grid_size + 1)
-        y_grid = np.linspace(y_min, y_max, grid_size + 1)
+        # edges in the dtype of the points, so binning never upcasts them
+        x_grid = np.linspace(x_min, x_max, grid_size + 1, dtype=self.X_pca.dtype)
+        y_grid = np.linspace(y_min, y_max, grid_size + 1, dtype=self.X_pca.dtype)
         
-        sampled_indices = []
-        for i in range(grid_size):
-            for j in range(grid_size):
-                x_start, x_end = x_grid[i], x_grid[i + 1]
-                y_start, y_end = y_grid[j], y_grid[j + 1]
-                
-                grid_indices = [
-                    idx for idx in cluster_indices 
-                    if x_start <= self.X_pca[idx, 0] < x_end and y_start <= self.X_pca[idx, 1] < y_end
-                ]
-                
-                if grid_indices:
-                    sampled_indices.append(np.random.choice(grid_indices))
+        points = self.X_pca[cluster_indices]
+        i = np.searchsorted(x_grid, points[:, 0], side='right') - 1
+        j = np.searchsorted(y_grid, points[:, 1], side='right') - 1
+        
+        inside = (i >= 0) & (i < grid_size) & (j >= 0) & (j < grid_size)
+        return np.where(inside, i * grid_size + j, -1)
+
 
-        while len(sampled_indices) < n_samples:
-            sampled_indices.append(np.random.choice(cluster_indices))
+def get_kd_leaf_ids(points, n_leaves):
+    # split the points into exactly n_leaves non-empty leaves: every node
+    # cuts its widest axis at the rank that gives each side its share of
+    # leaves, so each level is one argpartition and the whole tree O(n log k)
+    order = np.arange(len(points))
+    leaf_ids = np.empty(len(points), dtype=int)
+    stack = [(0, len(points), n_leaves, 0)]
+    while stack:
+        start, stop, k, first_leaf = stack.pop()
+        node = order[start:stop]
+        if k == 1:
+            leaf_ids[node] = first_leaf
+            continue
         
-        return sampled_indices[:n_samples]
+        coords = points[node]
+        axis = np.argmax(np.ptp(coords, axis=0))
+        k_left = k // 2
+        split = int(round((stop - start) * k_left / k))
+        split = min(max(split, k_left), stop - start - (k - k_left))
+        order[start:stop] = node[np.argpartition(coords[:, axis], split)]
+        
+        stack.append((start + split, stop, k - k_left, first_leaf + k_left))
+        stack.append((start, start + split, k_left, first_leaf))
+    return leaf_ids
 
-    def get_selected_samples(self):
-        selected_samples = []
-        unique_labels = np.unique(self.y)
-        for label in unique_labels:
-            label_indices = np.where(self.y == label)[0]
-            label_cluster_labels = self.cluster_labels[label_indices]
-            unique_clusters = np.unique(label_cluster_labels)
-            
-            for cluster_id in unique_clusters:
-                cluster_indices = label_indices[label_cluster_labels == cluster_id]
-                selected_indices = self.get_grid_sampled_indices(cluster_indices, self.n_samples)
-                selected_samples.extend(selected_indices)
-        return selected_samples
+
+class KDTreeImageClusterSampler(ImageClusterSampler):
+    def get_cell_grid_size(self):
+        return self.n_samples
+
+    def get_cell_count(self):
+        return self.n_samples
+
+    def get_cell_ids(self, indices):
+        return get_kd_leaf_ids(self.X_pca[indices], min(self.n_samples, len(indices)))
+
+    def get_group_cell_ids(self):
+        # leaves are built from each (label, cluster) group's own points;
+        # groups of at most n_samples points are taken whole and stay one cell
+        cell_ids = np.zeros(len(self.group_order), dtype=int)
+        for start, stop in zip(self.group_offsets[:-1], self.group_offsets[1:]):
+            if stop - start > self.n_samples:
+                cell_ids[start:stop] = self.get_cell_ids(self.group_order[start:stop])
+        return cell_ids
+
+    def get_kd_sampled_indices(self, cluster_indices, n_samples):
+        if len(cluster_indices) <= n_samples:
+            return cluster_indices
+        
+        cell_ids = get_kd_leaf_ids(self.X_pca[cluster_indices], n_samples)
+        return self.sample_cells(cluster_indices, cell_ids, n_samples)
+
+
+class HashedGridImageClusterSampler(ImageClusterSampler):
+    # rectangular grid over the first grid_dims columns of X_reduced; only
+    # occupied cells get an id, so cost follows the points, not grid_size ** d
+    grid_dims = None
+
+    def __init__(self, X, y, n_clusters, n_samples, grid_dims=None, **kwargs):
+        super().__init__(X, y, n_clusters, n_samples, **kwargs)
+        # X_reduced has n_components columns, two without n_components
+        if grid_dims and grid_dims > (self.n_components or 2):
+            raise ValueError(f'grid_dims={grid_dims} is more than the {self.n_components or 2} projected '
+                             f'dimensions, set n_components >= grid_dims')
+        self.grid_dims = grid_dims
+
+    def get_grid_dims(self):
+        return self.grid_dims or self.X_reduced.shape[1]
+
+    def get_settings(self):
+        return dict(super().get_settings(), grid_dims=self.grid_dims)
+
+    def get_cell_grid_size(self):
+        return self.grid_size or int(np.ceil(self.n_samples ** (1 / self.get_grid_dims())))
+
+    def get_cell_count(self):
+        return self.get_cell_grid_size() ** self.get_grid_dims()
+
+    def get_cell_ids(self, indices):
+        return self.get_hashed_cell_ids(indices, self.get_cell_grid_size(), self.get_grid_dims())
+
+    def get_hashed_cell_ids(self, cluster_indices, grid_size, grid_dims):
+        lows, highs = self.get_reduced_bounds()
+        lows, highs = lows[:grid_dims], highs[:grid_dims]
+        widths = np.where(highs > lows, (highs - lows) / grid_size, 1)
+        
+        points = self.X_reduced[cluster_indices, :grid_dims]
+        inside = np.all((points >= lows) & (points <= highs), axis=1)
+        # the clip only moves points on the upper bound into the last cell
+        cells = np.clip(np.floor((points - lows) / widths).astype(np.int64), 0, grid_size - 1)
+        
+        # ids are stable across calls, so chunks and batches binned separately agree
+        if grid_dims * np.log2(max(grid_size, 2)) < 62:
+            # mixed-radix key fits in int64
+            cell_ids = cells @ (grid_size ** np.arange(grid_dims, dtype=np.int64))
+        else:
+            # otherwise hash the coordinates, int64 products wrap around
+            multipliers = np.random.default_rng(grid_dims).integers(1, 2 ** 62, size=grid_dims) | 1
+            with np.errstate(over='ignore'):
+                cell_ids = (cells @ multipliers) & (2 ** 62 - 1)
+        return np.where(inside, cell_ids, -1)
+
+    def get_hashed_sampled_indices(self, cluster_indices, n_samples, grid_dims=None):
+        if len(cluster_indices) <= n_samples:
+            return cluster_indices
+        
+        grid_dims = grid_dims or self.get_grid_dims()
+        grid_size = int(np.ceil(n_samples ** (1 / grid_dims)))
+        cell_ids = self.get_hashed_cell_ids(cluster_indices, grid_size, grid_dims)
+        return self.sample_cells(cluster_indices, cell_ids, n_samples)
+
+
+class HexagonalImageClusterSampler(ImageClusterSampler):
+    # pointy-top hexagons, grid_size of them across the x range
+    def get_cell_grid_size(self):
+        return self.grid_size or int(np.ceil(np.sqrt(self.n_samples)))
+
+    def get_hex_layout(self, grid_size):
+        # hexagon radius plus the axial (q, r) range that covers the bounds
+        x_min, x_max, y_min, y_max = self.get_bounds()
+        radius = (x_max - x_min) / (grid_size * np.sqrt(3))
+        corners = np.array([[x_min, y_min], [x_min, y_max], [x_max, y_min], [x_max, y_max]])
+        q, r = self.get_axial_coords(corners, radius)
+        return radius, q.min() - 1, q.max() + 1, r.min() - 1, r.max() + 1
+
+    def get_axial_coords(self, points, radius):
+        x_min, _, y_min, _ = self.get_bounds()
+        x = points[:, 0] - x_min
+        y = points[:, 1] - y_min
+        q = (np.sqrt(3) / 3 * x - y / 3) / radius
+        r = (2 / 3 * y) / radius
+        
+        # cube rounding: round all three cube coordinates, then recompute the
+        # one that moved furthest from the other two
+        cube = np.stack([q, -q - r, r])
+        rounded = np.round(cube)
+        diff = np.abs(rounded - cube)
+        worst = np.argmax(diff, axis=0)
+        columns = np.arange(len(x))
+        rounded[worst, columns] = 0
+        rounded[worst, columns] = -rounded.sum(axis=0)[columns]
+        return rounded[0].astype(int), rounded[2].astype(int)
+
+    def get_cell_count(self):
+        _, q_lo, q_hi, r_lo, r_hi = self.get_hex_layout(self.get_cell_grid_size())
+        return (q_hi - q_lo + 1) * (r_hi - r_lo + 1)
+
+    def get_cell_ids(self, indices):
+        return self.get_hexagon_cell_ids(indices, self.get_cell_grid_size())
+
+    def get_hexagon_cell_ids(self, cluster_indices, grid_size):
+        radius, q_lo, q_hi, r_lo, r_hi = self.get_hex_layout(grid_size)
+        q, r = self.get_axial_coords(self.X_pca[cluster_indices], radius)
+        inside = (q >= q_lo) & (q <= q_hi) & (r >= r_lo) & (r <= r_hi)
+        return np.where(inside, (q - q_lo) * (r_hi - r_lo + 1) + (r - r_lo), -1)
+
+    def get_hexagon_sampled_indices(self, cluster_indices, n_samples, grid_size=None):
+        if len(cluster_indices) <= n_samples:
+            return cluster_indices
+        
+        grid_size = grid_size or int(np.ceil(np.sqrt(n_samples)))
+        cell_ids = self.get_hexagon_cell_ids(cluster_indices, grid_size)
+        return self.sample_cells(cluster_indices, cell_ids, n_samples)
+
+    def plot_clusters_with_hexagons(self, grid_size=None, path=None):
+        x_min, x_max, y_min, y_max = self.get_bounds()
+        radius, q_lo, q_hi, r_lo, r_hi = self.get_hex_layout(grid_size or self.get_cell_grid_size())
+        q, r = np.meshgrid(np.arange(q_lo, q_hi + 1), np.arange(r_lo, r_hi + 1))
+        centers_x = x_min + radius * np.sqrt(3) * (q.ravel() + r.ravel() / 2)
+        centers_y = y_min + radius * 1.5 * r.ravel()
+        visible = ((centers_x > x_min - radius) & (centers_x < x_max + radius) &
+                   (centers_y > y_min - radius) & (centers_y < y_max + radius))
+        
+        angles = np.radians(30 + 60 * np.arange(6))
+        vertices = np.stack([
+            centers_x[visible, None] + radius * np.cos(angles),
+            centers_y[visible, None] + radius * np.sin(angles),
+        ], axis=-1)
+        
+        with self.plot_figure('Clustering with Hexagonal Grids', path) as ax:
+            self.scatter_clusters(ax, alpha=0.5)
+            self.add_cell_outlines(ax, vertices)
 
 
 class ParallelogramImageClusterSampler(ImageClusterSampler):
@@ -146,12 +1037,7 @@ class ParallelogramImageClusterSampler(ImageClusterSampler):
         grid_size = int(np.ceil(np.sqrt(x_length * y_length)))
         return grid_size
 
-    def plot_clusters_with_parallelograms(self, angle=30, grid_size=10):
-        plt.figure(figsize=(10, 6))
-        for i in range(self.n_clusters):
-            cluster_data = self.X_pca[self.cluster_labels == i]
-            plt.scatter(cluster_data[:, 0], cluster_data[:, 1], label=f'Cluster {i}', alpha=0.5)
-        
+    def plot_clusters_with_parallelograms(self, angle=30, grid_size=10, path=None):
         x_min, x_max = np.min(self.X_pca[:, 0]), np.max(self.X_pca[:, 0])
         y_min, y_max = np.min(self.X_pca[:, 1]), np.max(self.X_pca[:, 1])
         
@@ -159,158 +1045,122 @@ class ParallelogramImageClusterSampler(ImageClusterSampler):
         dx = x_length * np.cos(np.radians(angle))
         dy = x_length * np.sin(np.radians(angle))
         y_length = dy
-
-        for i in range(grid_size):
-            for j in range(grid_size):
-                x_start = x_min + i * x_length
-                y_start = y_min + j * y_length
-
-                parallelogram = [
-                    (x_start, y_start),
-                    (x_start + x_length, y_start),
-                    (x_start + x_length + dx, y_start + dy),
-                    (x_start + dx, y_start + dy)
-                ]
-                
-                parallelogram_x, parallelogram_y = zip(*parallelogram)
-                plt.plot(parallelogram_x + (parallelogram_x[0],), parallelogram_y + (parallelogram_y[0],), 'k--', alpha=0.5)
-        
-        plt.title('Clustering with Parallelogram Grids')
-        plt.xlabel('PCA Component 1')
-        plt.ylabel('PCA Component 2')
-        plt.legend()
-        plt.show()
+        
+        i, j = np.meshgrid(np.arange(grid_size), np.arange(grid_size), indexing='ij')
+        x_start = (x_min + i * x_length).ravel()
+        y_start = (y_min + j * y_length).ravel()
+        vertices = np.stack([
+            np.stack([x_start, x_start + x_length, x_start + x_length + dx, x_start + dx], axis=1),
+            np.stack([y_start, y_start, y_start + dy, y_start + dy], axis=1),
+        ], axis=-1)
+        
+        with self.plot_figure('Clustering with Parallelogram Grids', path) as ax:
+            self.scatter_clusters(ax, alpha=0.5)
+            self.add_cell_outlines(ax, vertices)
     
     def get_parallelogram_sampled_indices(self, cluster_indices, n_samples, angle=30, grid_size=10):
         if len(cluster_indices) <= n_samples:
             return cluster_indices
         
-        x_min, x_max = np.min(self.X_pca[:, 0]), np.max(self.X_pca[:, 0])
-        y_min, y_max = np.min(self.X_pca[:, 1]), np.max(self.X_pca[:, 1])
+        cell_ids = self.get_parallelogram_cell_ids(cluster_indices, angle, grid_size)
+        return self.sample_cells(cluster_indices, cell_ids, n_samples)
+
+    def get_cell_grid_size(self):
+        return self.grid_size or 10
+
+    def get_cell_count(self):
+        return self.get_cell_grid_size() ** 2
+
+    def get_cell_ids(self, indices):
+        return self.get_parallelogram_cell_ids(indices, 30, self.get_cell_grid_size())
+
+    def get_parallelogram_cell_ids(self, cluster_indices, angle, grid_size):
+        x_min, x_max, y_min, _ = self.get_bounds()
         
         x_length = (x_max - x_min) / grid_size
         dx = x_length * np.cos(np.radians(angle))
         dy = x_length * np.sin(np.radians(angle))
-        y_length = dy
-        
-        sampled_indices = []
         
-        for i in range(grid_size):
-            for j in range(grid_size):
-                x_start = x_min + i * x_length
-                y_start = y_min + j * y_length
-
-                parallelogram_indices = [
-                    idx for idx in cluster_indices 
-                    if (self.X_pca[idx, 0] >= x_start and self.X_pca[idx, 0] < x_start + x_length + dx and
-                        self.X_pca[idx, 1] >= y_start and self.X_pca[idx, 1] < y_start + y_length and
-                        (self.X_pca[idx, 1] - y_start) < dy / dx * (self.X_pca[idx, 0] - x_start + x_length))
-                ]
-                
-                if parallelogram_indices:
-                    sampled_indices.append(np.random.choice(parallelogram_indices))
-
-        while len(sampled_indices) < n_samples:
-            sampled_indices.append(np.random.choice(cluster_indices))
+        # undo the row shear to get lattice coordinates; every row starts at
+        # x_min like the drawn grid, so only the height inside the row shears
+        points = self.X_pca[cluster_indices]
+        v = (points[:, 1] - y_min) / dy
+        j = np.floor(v).astype(int)
+        u = (points[:, 0] - x_min - (v - j) * dx) / x_length
+        i = np.floor(u).astype(int)
         
-        return sampled_indices[:n_samples]
-
-    def get_selected_samples(self):
-        selected_samples = []
-        unique_labels = np.unique(self.y)
-        for label in unique_labels:
-            label_indices = np.where(self.y == label)[0]
-            label_cluster_labels = self.cluster_labels[label_indices]
-            unique_clusters = np.unique(label_cluster_labels)
-            
-            for cluster_id in unique_clusters:
-                cluster_indices = label_indices[label_cluster_labels == cluster_id]
-                selected_indices = self.get_parallelogram_sampled_indices(cluster_indices, self.n_samples)
-                selected_samples.extend(selected_indices)
-        return selected_samples
+        inside = (i >= 0) & (i < grid_size) & (j >= 0) & (j < grid_size)
+        return np.where(inside, i * grid_size + j, -1)
 
 
 class TriangularImageClusterSampler(ImageClusterSampler):
-    def plot_clusters_with_triangles(self, grid_size=10):
-        plt.figure(figsize=(10, 6))
-        for i in range(self.n_clusters):
-            cluster_data = self.X_pca[self.cluster_labels == i]
-            plt.scatter(cluster_data[:, 0], cluster_data[:, 1], label=f'Cluster {i}', alpha=0.5)
-        
+    def plot_clusters_with_triangles(self, grid_size=10, path=None):
         x_min, x_max = np.min(self.X_pca[:, 0]), np.max(self.X_pca[:, 0])
         y_min, y_max = np.min(self.X_pca[:, 1]), np.max(self.X_pca[:, 1])
         
         side_length = (x_max - x_min) / grid_size
         height = np.sqrt(3) / 2 * side_length
         
-        for i in range(-1, grid_size + 1):
-            for j in range(-1, grid_size + 1):
-                x_start = x_min + i * side_length
-                y_start = y_min + j * height
-
-                if (i + j) % 2 == 0:
-                    triangle = [
-                        (x_start, y_start),
-                        (x_start + side_length / 2, y_start + height),
-                        (x_start - side_length / 2, y_start + height)
-                    ]
-                else:
-                    triangle = [
-                        (x_start, y_start),
-                        (x_start + side_length, y_start),
-                        (x_start + side_length / 2, y_start + height)
-                    ]
-
-                triangle_x, triangle_y = zip(*triangle)
-                plt.plot(triangle_x + (triangle_x[0],), triangle_y + (triangle_y[0],), 'k--', alpha=0.5)
-        
-        plt.title('Clustering with Triangular Grids')
-        plt.xlabel('PCA Component 1')
-        plt.ylabel('PCA Component 2')
-        plt.legend()
-        plt.show()
+        i, j = np.meshgrid(np.arange(-1, grid_size + 1), np.arange(-1, grid_size + 1), indexing='ij')
+        x_start = (x_min + i * side_length).ravel()
+        y_start = (y_min + j * height).ravel()
+        # even i + j points down from the row top, odd i + j points up from the row bottom
+        down = ((i + j) % 2 == 0).ravel()
+        vertices = np.stack([
+            np.stack([x_start,
+                      x_start + np.where(down, side_length / 2, side_length),
+                      x_start + np.where(down, -side_length / 2, side_length / 2)], axis=1),
+            np.stack([y_start,
+                      y_start + np.where(down, height, 0),
+                      y_start + height], axis=1),
+        ], axis=-1)
+        
+        with self.plot_figure('Clustering with Triangular Grids', path) as ax:
+            self.scatter_clusters(ax, alpha=0.5)
+            self.add_cell_outlines(ax, vertices)
     
     def get_triangle_sampled_indices(self, cluster_indices, grid_size=10):
         if len(cluster_indices) <= self.n_samples:
             return cluster_indices
         
-        x_min, x_max = np.min(self.X_pca[:, 0]), np.max(self.X_pca[:, 0])
-        y_min, y_max = np.min(self.X_pca[:, 1]), np.max(self.X_pca[:, 1])
+        cell_ids = self.get_triangle_cell_ids(cluster_indices, grid_size)
+        return self.sample_cells(cluster_indices, cell_ids, self.n_samples)
+
+    def get_cell_grid_size(self):
+        return self.grid_size or self.n_samples
+
+    def get_cell_count(self):
+        return (self.get_cell_grid_size() + 2) ** 2
+
+    def get_cell_ids(self, indices):
+        return self.get_triangle_cell_ids(indices, self.get_cell_grid_size())
+
+    def get_triangle_cell_ids(self, cluster_indices, grid_size):
+        x_min, x_max, y_min, _ = self.get_bounds()
         
         side_length = (x_max - x_min) / grid_size
         height = np.sqrt(3) / 2 * side_length
         
-        sampled_indices = []
-        
-        for i in range(-1, grid_size + 1):
-            for j in range(-1, grid_size + 1):
-                x_start = x_min + i * side_length
-                y_start = y_min + j * height
-
-                if (i + j) % 2 == 0:
-                    triangle_indices = [
-                        idx for idx in cluster_indices 
-                        if self.point_in_triangle(self.X_pca[idx], 
-                                                  (x_start, y_start), 
-                                                  (x_start + side_length / 2, y_start + height), 
-                                                  (x_start - side_length / 2, y_start + height))
-                    ]
-                else:
-                    triangle_indices = [
-                        idx for idx in cluster_indices 
-                        if self.point_in_triangle(self.X_pca[idx], 
-                                                  (x_start, y_start), 
-                                                  (x_start + side_length, y_start), 
-                                                  (x_start + side_length / 2, y_start + height))
-                    ]
-
-                if triangle_indices:
-                    sampled_indices.append(np.random.choice(triangle_indices))
-
-        while len(sampled_indices) < self.n_samples:
-            sampled_indices.append(np.random.choice(cluster_indices))
+        points = self.X_pca[cluster_indices]
+        u = (points[:, 0] - x_min) / side_length
+        v = (points[:, 1] - y_min) / height
+        
+        # row j and the relative height t inside that row; at height t a
+        # downward triangle (even i + j) spans u in i +- t / 2 and an upward
+        # one (odd i + j) spans u in [i + t / 2, i + 1 - t / 2]
+        j = np.floor(v).astype(int)
+        t = v - j
+        
+        i_down = np.floor(u + 0.5).astype(int)
+        in_down = ((i_down + j) % 2 == 0) & (np.abs(u - i_down) < t / 2)
+        
+        i_up = np.floor(u).astype(int)
+        f = u - i_up
+        in_up = ((i_up + j) % 2 == 1) & (f > t / 2) & (f < 1 - t / 2)
         
-        return sampled_indices[:self.n_samples]
+        i = np.where(in_down, i_down, i_up)
+        inside = (in_down | in_up) & (i >= -1) & (i <= grid_size) & (j >= -1) & (j <= grid_size)
+        return np.where(inside, (i + 1) * (grid_size + 2) + (j + 1), -1)
     
     def point_in_triangle(self, point, v1, v2, v3):
         def sign(p1, p2, p3):
@@ -322,43 +1172,12 @@ class TriangularImageClusterSampler(ImageClusterSampler):
         
         return ((b1 == b2) & (b2 == b3))
 
-    def get_selected_samples(self):
-        selected_samples = []
-        unique_labels = np.unique(self.y)
-        for label in unique_labels:
-            label_indices = np.where(self.y == label)[0]
-            label_cluster_labels = self.cluster_labels[label_indices]
-            unique_clusters = np.unique(label_cluster_labels)
-            
-            for cluster_id in unique_clusters:
-                cluster_indices = label_indices[label_cluster_labels == cluster_id]
-                selected_indices = self.get_triangle_sampled_indices(cluster_indices, self.n_samples)
-                selected_samples.extend(selected_indices)
-        return selected_samples
-
-    def plot_selected_samples_on_clusters(self, selected_samples):
-        plt.figure(figsize=(10, 6))
-        for i in range(self.n_clusters):
-            cluster_data = self.X_pca[self.cluster_labels == i]
-            plt.scatter(cluster_data[:, 0], cluster_data[:, 1], label=f'Cluster {i}', alpha=0.5)
-        
-        selected_data = self.X_pca[selected_samples]
-        plt.scatter(selected_data[:, 0], selected_data[:, 1], color='red', label='Selected Samples', edgecolor='k')
-        
-        plt.title('Clustering with Selected Samples')
-        plt.xlabel('PCA Component 1')
-        plt.ylabel('PCA Component 2')
-        plt.legend()
-        plt.show()
+    def plot_selected_samples_on_clusters(self, selected_samples, path=None, title='Clustering with Selected Samples'):
+        super().plot_selected_samples_on_clusters(selected_samples, path, title)
 
 
 class BrickImageClusterSampler(ImageClusterSampler):
-    def plot_clusters_with_bricks(self, grid_size=10):
-        plt.figure(figsize=(10, 6))
-        for i in range(self.n_clusters):
-            cluster_data = self.X_pca[self.cluster_labels == i]
-            plt.scatter(cluster_data[:, 0], cluster_data[:, 1], label=f'Cluster {i}', alpha=0.5)
-        
+    def plot_clusters_with_bricks(self, grid_size=10, path=None):
         x_min, x_max = np.min(self.X_pca[:, 0]), np.max(self.X_pca[:, 0])
         y_min, y_max = np.min(self.X_pca[:, 1]), np.max(self.X_pca[:, 1])
         
@@ -367,64 +1186,351 @@ class BrickImageClusterSampler(ImageClusterSampler):
         
         skew_factor = (x_max - x_min) / (grid_size * 2)
         
-        for i in range(grid_size):
-            for j in range(grid_size):
-                x_start, x_end = x_grid[i] + j * skew_factor, x_grid[i + 1] + j * skew_factor
-                y_start, y_end = y_grid[j], y_grid[j + 1]
-                
-                plt.plot([x_start, x_end], [y_start, y_start], 'k--', alpha=0.5)
-                plt.plot([x_start, x_end], [y_end, y_end], 'k--', alpha=0.5)
-                plt.plot([x_start, x_start], [y_start, y_end], 'k--', alpha=0.5)
-                plt.plot([x_end, x_end], [y_start, y_end], 'k--', alpha=0.5)
-        
-        plt.title('Clustering of Cats and Dogs with Brick Grids')
-        plt.xlabel('PCA Component 1')
-        plt.ylabel('PCA Component 2')
-        plt.legend()
-        plt.show()
+        i, j = np.meshgrid(np.arange(grid_size), np.arange(grid_size), indexing='ij')
+        x_start = (x_grid[i] + j * skew_factor).ravel()
+        x_end = (x_grid[i + 1] + j * skew_factor).ravel()
+        y_start, y_end = y_grid[j].ravel(), y_grid[j + 1].ravel()
+        vertices = np.stack([
+            np.stack([x_start, x_end, x_end, x_start], axis=1),
+            np.stack([y_start, y_start, y_end, y_end], axis=1),
+        ], axis=-1)
+        
+        with self.plot_figure('Clustering of Cats and Dogs with Brick Grids', path) as ax:
+            self.scatter_clusters(ax, alpha=0.5)
+            self.add_cell_outlines(ax, vertices)
     
     def get_brick_sampled_indices(self, cluster_indices, n_samples, grid_size=10):
         if len(cluster_indices) <= n_samples:
             return cluster_indices
         
-        x_min, x_max = np.min(self.X_pca[:, 0]), np.max(self.X_pca[:, 0])
-        y_min, y_max = np.min(self.X_pca[:, 1]), np.max(self.X_pca[:, 1])
-        
-        x_grid = np.linspace(x_min, x_max, grid_size + 1)
-        y_grid = np.linspace(y_min, y_max, grid_size + 1)
+        cell_ids = self.get_brick_cell_ids(cluster_indices, grid_size)
+        return self.sample_cells(cluster_indices, cell_ids, n_samples)
+
+    def get_cell_grid_size(self):
+        return self.grid_size or 10
+
+    def get_cell_count(self):
+        return self.get_cell_grid_size() ** 2
+
+    def get_cell_ids(self, indices):
+        return self.get_brick_cell_ids(indices, self.get_cell_grid_size())
+
+    def get_brick_cell_ids(self, cluster_indices, grid_size):
+        x_min, x_max, y_min, y_max = self.get_bounds()
         
-        sampled_indices = []
+        x_grid = np.linspace(x_min, x_max, grid_size + 1, dtype=self.X_pca.dtype)
+        y_grid = np.linspace(y_min, y_max, grid_size + 1, dtype=self.X_pca.dtype)
         skew_factor = (x_max - x_min) / (grid_size * 2)
         
-        for i in range(grid_size):
-            for j in range(grid_size):
-                x_start, x_end = x_grid[i] + j * skew_factor, x_grid[i + 1] + j * skew_factor
-                y_start, y_end = y_grid[j], y_grid[j + 1]
-                
-                grid_indices = [
-                    idx for idx in cluster_indices 
-                    if x_start <= self.X_pca[idx, 0] < x_end and y_start <= self.X_pca[idx, 1] < y_end
-                ]
-                
-                if grid_indices:
-                    sampled_indices.append(np.random.choice(grid_indices))
+        # row j is shifted right by j * skew_factor; undo the shift, then
+        # bin against the unshifted column edges
+        points = self.X_pca[cluster_indices]
+        j = np.searchsorted(y_grid, points[:, 1], side='right') - 1
+        i = np.searchsorted(x_grid, points[:, 0] - j * skew_factor, side='right') - 1
+        
+        inside = (i >= 0) & (i < grid_size) & (j >= 0) & (j < grid_size)
+        return np.where(inside, i * grid_size + j, -1)
+
+
+class CellReservoir:
+    # bottom-k sampling: every point gets a uniform random key and each
+    # (group, cell) keeps the capacity smallest keys seen so far, which is a
+    # uniform sample without replacement that can be merged chunk by chunk.
+    # Every (group, cell) owns a row of slot arrays found through a dict, so
+    # an update only reads and writes the rows its batch touches
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.slots = {}
+        self.group_slots = defaultdict(list)
+        self.keys = np.full((0, capacity), np.inf)
+        self.indices = np.full((0, capacity), -1, dtype=np.int64)
 
-        while len(sampled_indices) < n_samples:
-            sampled_indices.append(np.random.choice(cluster_indices))
+    def get_slots(self, groups, cells):
+        slots = np.empty(len(groups), dtype=np.int64)
+        for i, (group, cell) in enumerate(zip(groups.tolist(), cells.tolist())):
+            slot = self.slots.get((group, cell))
+            if slot is None:
+                slot = self.slots[group, cell] = len(self.slots)
+                self.group_slots[group].append((cell, slot))
+            slots[i] = slot
         
-        return sampled_indices[:n_samples]
+        if len(self.slots) > len(self.keys):
+            # amortized doubling, rows past len(self.slots) stay unused
+            n_rows = max(len(self.slots), 2 * len(self.keys))
+            self.keys = np.r_[self.keys, np.full((n_rows - len(self.keys), self.capacity), np.inf)]
+            self.indices = np.r_[self.indices, np.full((n_rows - len(self.indices), self.capacity), -1, dtype=np.int64)]
+        return slots
+
+    def update(self, groups, cells, keys, indices):
+        if len(groups) == 0:
+            return
+        
+        # bottom-k within the batch first, one padded row per (group, cell)
+        order = np.lexsort((keys, cells, groups))
+        groups, cells = groups[order], cells[order]
+        run_change = np.r_[True, (groups[1:] != groups[:-1]) | (cells[1:] != cells[:-1])]
+        positions = np.arange(len(order))
+        rank = positions - np.maximum.accumulate(np.where(run_change, positions, 0))
+        run_ids = np.cumsum(run_change) - 1
+        kept = rank < self.capacity
+        
+        batch_keys = np.full((run_change.sum(), self.capacity), np.inf)
+        batch_indices = np.full((run_change.sum(), self.capacity), -1, dtype=np.int64)
+        batch_keys[run_ids[kept], rank[kept]] = keys[order[kept]]
+        batch_indices[run_ids[kept], rank[kept]] = indices[order[kept]]
+        
+        # merge with the touched rows only, rows stay sorted by key
+        slots = self.get_slots(groups[run_change], cells[run_change])
+        merged_keys = np.concatenate([self.keys[slots], batch_keys], axis=1)
+        merged_indices = np.concatenate([self.indices[slots], batch_indices], axis=1)
+        smallest = np.argsort(merged_keys, axis=1)[:, :self.capacity]
+        self.keys[slots] = np.take_along_axis(merged_keys, smallest, axis=1)
+        self.indices[slots] = np.take_along_axis(merged_indices, smallest, axis=1)
+
+    def get_group(self, group):
+        # entries of one group, ordered by cell and then key
+        cells, indices = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+        for cell, slot in sorted(self.group_slots.get(group, [])):
+            filled = np.isfinite(self.keys[slot])
+            cells.append(np.full(filled.sum(), cell, dtype=np.int64))
+            indices.append(self.indices[slot][filled])
+        return np.concatenate(cells), np.concatenate(indices)
+
+
+class ReservoirDistiller:
+    # distilled set kept as reservoirs instead of a full cell index: one
+    # random point per (group, cell) for the cell picks and n_samples per
+    # group for the uniform top-up; memory follows the cells, not the points
+    def __init__(self, sampler, random_state=None):
+        if type(sampler).get_group_cell_ids is not ImageClusterSampler.get_group_cell_ids:
+            raise ValueError(f'{type(sampler).__name__} builds cells from whole groups and cannot be streamed')
+        self.sampler = sampler
+        self.rng = np.random.default_rng(random_state)
+        self.labels = np.empty(0, dtype=np.asarray(sampler.y).dtype)
+        self.group_sizes = np.zeros(0, dtype=np.int64)
+        self.cell_reservoir = CellReservoir(1)
+        self.group_reservoir = CellReservoir(sampler.n_samples)
+        self.cell_sampler = None
+
+    def iter_projected_chunks(self, X):
+        sampler = self.sampler
+        for start, chunk in sampler.iter_chunks(X):
+            X_reduced = sampler.pca.transform(chunk)
+            features = chunk if sampler.n_components is None else X_reduced
+            yield start, X_reduced, features
+
+    def get_groups(self, y, clusters):
+        # labels get codes in order of appearance, so batches can add new ones
+        new_labels = np.setdiff1d(np.unique(y), self.labels)
+        if len(new_labels):
+            self.labels = np.concatenate([self.labels, new_labels])
+        label_order = np.argsort(self.labels)
+        label_codes = label_order[np.searchsorted(self.labels[label_order], y)]
+        return label_codes.astype(np.int64) * self.sampler.n_clusters + clusters
+
+    def get_cells(self, X_reduced):
+        # the sampler's own binning on a chunk, against the fitted bounds
+        self.cell_sampler.X_reduced = X_reduced
+        self.cell_sampler.X_pca = X_reduced[:, :2]
+        return np.asarray(self.cell_sampler.get_cell_ids(np.arange(len(X_reduced))), dtype=np.int64)
+
+    def update(self, groups, cells, indices):
+        n_groups = len(self.labels) * self.sampler.n_clusters
+        if n_groups > len(self.group_sizes):
+            self.group_sizes = np.r_[self.group_sizes, np.zeros(n_groups - len(self.group_sizes), dtype=np.int64)]
+        np.add.at(self.group_sizes, groups, 1)
+        
+        inside = cells >= 0
+        self.cell_reservoir.update(groups[inside], cells[inside], self.rng.random(inside.sum()), indices[inside])
+        self.group_reservoir.update(groups, np.zeros_like(groups), self.rng.random(len(groups)), indices)
+
+    def update_chunks(self, X, y, first_index):
+        for start, X_reduced, features in self.iter_projected_chunks(X):
+            clusters = self.sampler.kmeans.predict(features)
+            groups = self.get_groups(np.asarray(y[start:start + len(clusters)]), clusters)
+            indices = np.arange(first_index + start, first_index + start + len(clusters))
+            self.update(groups, self.get_cells(X_reduced), indices)
 
     def get_selected_samples(self):
+        n_samples = self.sampler.n_samples
+        n_clusters = self.sampler.n_clusters
         selected_samples = []
-        unique_labels = np.unique(self.y)
-        for label in unique_labels:
-            label_indices = np.where(self.y == label)[0]
-            label_cluster_labels = self.cluster_labels[label_indices]
-            unique_clusters = np.unique(label_cluster_labels)
-            
-            for cluster_id in unique_clusters:
-                cluster_indices = label_indices[label_cluster_labels == cluster_id]
-                selected_indices = self.get_brick_sampled_indices(cluster_indices, self.n_samples)
-                selected_samples.extend(selected_indices)
+        for label_code in np.argsort(self.labels):
+            for group in range(label_code * n_clusters, (label_code + 1) * n_clusters):
+                if self.group_sizes[group] == 0:
+                    continue
+                
+                _, group_indices = self.group_reservoir.get_group(group)
+                if self.group_sizes[group] <= n_samples:
+                    selected_samples.extend(np.sort(group_indices))
+                    continue
+                
+                _, picks = self.cell_reservoir.get_group(group)
+                sampled_indices = picks[:n_samples].tolist()
+                # group reservoir is in key order, so its first unpicked entries
+                # are a uniform draw without replacement from the unpicked points
+                fill = group_indices[~np.isin(group_indices, sampled_indices)]
+                selected_samples.extend(sampled_indices + fill[:n_samples - len(sampled_indices)].tolist())
         return selected_samples
 
+
+class OutOfCoreDistiller(ReservoirDistiller):
+    # two passes over X on disk: pass one fits the sampler's projection and
+    # clustering on a random sample of rows and streams the data once for the
+    # projection bounds, pass two streams it again into the reservoirs
+    def __init__(self, sampler, fit_size=10000, random_state=None):
+        super().__init__(sampler, random_state)
+        self.fit_size = fit_size
+
+    def fit(self):
+        sampler = self.sampler
+        n_points = sampler.X.shape[0]
+        rows = np.sort(self.rng.choice(n_points, size=min(self.fit_size, n_points), replace=False))
+        
+        # the sample is streamed in chunks like X itself; only PCA and KMeans,
+        # which have no partial_fit, need their whole input in memory. Clones
+        # keep partial_fit from continuing an earlier fit
+        sampler.pca, sampler.kmeans = clone(sampler.pca), clone(sampler.kmeans)
+        if hasattr(sampler.pca, 'partial_fit'):
+            sampler.partial_fit_pca(rows)
+        else:
+            sampler.pca.fit(np.concatenate([chunk for _, chunk in sampler.iter_chunks(rows=rows)]))
+        
+        features = (chunk if sampler.n_components is None else sampler.pca.transform(chunk)
+                    for _, chunk in sampler.iter_chunks(rows=rows))
+        if hasattr(sampler.kmeans, 'partial_fit'):
+            for chunk_features in features:
+                sampler.kmeans.partial_fit(chunk_features)
+        else:
+            sampler.kmeans.fit(np.concatenate(list(features)))
+        
+        n_components = sampler.pca.components_.shape[0]
+        lows, highs = np.full(n_components, np.inf), np.full(n_components, -np.inf)
+        for _, X_reduced, _ in self.iter_projected_chunks(sampler.X):
+            lows = np.minimum(lows, X_reduced.min(axis=0))
+            highs = np.maximum(highs, X_reduced.max(axis=0))
+        
+        sampler.reduced_bounds = (lows, highs)
+        sampler.bounds = (lows[0], highs[0], lows[1], highs[1])
+        self.cell_sampler = type(sampler).from_fitted(sampler, sampler.n_samples, sampler.grid_size)
+        return self
+
+    def distill(self):
+        if self.cell_sampler is None:
+            self.fit()
+        self.update_chunks(self.sampler.X, self.sampler.y, 0)
+        return self.get_selected_samples()
+
+
+class OnlineDistiller(ReservoirDistiller):
+    # keeps a fitted sampler's distilled set current as labeled batches
+    # arrive: batches are projected with the fitted PCA, assigned with
+    # KMeans.predict and binned against the fitted bounds, so an update only
+    # touches the batch's reservoirs; indices count through the initial data
+    # and then every batch in arrival order
+    def __init__(self, sampler, random_state=None):
+        super().__init__(sampler, random_state)
+        if sampler.cluster_labels is None:
+            sampler.cluster_images()
+        sampler.get_bounds()
+        sampler.get_reduced_bounds()
+        self.cell_sampler = type(sampler).from_fitted(sampler, sampler.n_samples, sampler.grid_size)
+        
+        n_points = len(sampler.cluster_labels)
+        cells = np.asarray(sampler.get_cell_ids(np.arange(n_points)), dtype=np.int64)
+        groups = self.get_groups(np.asarray(sampler.y), sampler.cluster_labels.astype(np.int64))
+        self.update(groups, cells, np.arange(n_points))
+        self.n_seen = n_points
+
+    def partial_fit(self, X_batch, y_batch):
+        self.update_chunks(X_batch, y_batch, self.n_seen)
+        self.n_seen += len(X_batch)
+        return self
+
+
+def load_image(path, size, mode):
+    from PIL import Image
+
+    with Image.open(path) as image:
+        return np.asarray(image.convert(mode).resize(size), dtype=np.uint8)
+
+
+def load_image_directory(data_dir, classes=None, size=(128, 128), mode='RGB', cache_dir=None, n_jobs=None):
+    # data_dir/<class>/<image> decoded and resized in a thread pool straight
+    # into one uint8 array; with cache_dir the array is an .npy memmap that
+    # later calls reopen without decoding, as long as the directory, its
+    # files and the classes, size and mode are unchanged
+    if classes is None:
+        classes = sorted(name for name in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, name)))
+
+    paths, labels = [], []
+    for label, class_name in enumerate(classes):
+        class_dir = os.path.join(data_dir, class_name)
+        for file_name in sorted(os.listdir(class_dir)):
+            if not file_name.startswith('.'):
+                paths.append(os.path.join(class_dir, file_name))
+                labels.append(label)
+    if not paths:
+        raise ValueError(f"No images found in '{data_dir}' for classes {list(classes)}")
+
+    if cache_dir is not None:
+        # the file list with sizes and mtimes, hashed so settings.json stays small
+        digest = hashlib.sha256()
+        for path in paths:
+            stat = os.stat(path)
+            digest.update(repr((os.path.relpath(path, data_dir), stat.st_size, stat.st_mtime_ns)).encode())
+        settings = {
+            'data_dir': os.path.abspath(data_dir),
+            'classes': list(classes),
+            'size': list(size),
+            'mode': mode,
+            'n_files': len(paths),
+            'files_digest': digest.hexdigest(),
+        }
+        images_path = os.path.join(cache_dir, 'images.npy')
+        labels_path = os.path.join(cache_dir, 'labels.npy')
+        settings_path = os.path.join(cache_dir, 'settings.json')
+        if os.path.exists(images_path) and os.path.exists(labels_path) and os.path.exists(settings_path):
+            with open(settings_path) as f:
+                if json.load(f) == settings:
+                    return np.load(images_path, mmap_mode='r'), np.load(labels_path)
+        # stale or incomplete, the labels go first so a failed rebuild is never reused
+        if os.path.exists(labels_path):
+            os.remove(labels_path)
+
+    y = np.array(labels, dtype=np.int64)
+
+    first_image = load_image(paths[0], size, mode)
+    shape = (len(paths),) + first_image.shape
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        X = np.lib.format.open_memmap(images_path, mode='w+', dtype=np.uint8, shape=shape)
+    else:
+        X = np.empty(shape, dtype=np.uint8)
+
+    def decode(i):
+        X[i] = load_image(paths[i], size, mode)
+
+    # PIL releases the GIL while decoding and resizing, so threads scale
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        list(pool.map(decode, range(len(paths))))
+
+    if cache_dir is not None:
+        X.flush()
+        with open(settings_path, 'w') as f:
+            json.dump(settings, f)
+        # labels are written last and mark the cache as complete
+        np.save(labels_path, y)
+        X = np.load(images_path, mmap_mode='r')
+    return X, y
+
+
+SHAPES = {
+    'rectangle': GridImageClusterSampler,
+    'parallelogram': ParallelogramImageClusterSampler,
+    'triangle': TriangularImageClusterSampler,
+    'brick': BrickImageClusterSampler,
+    'kdtree': KDTreeImageClusterSampler,
+    'hashed': HashedGridImageClusterSampler,
+    'hexagon': HexagonalImageClusterSampler,
+}